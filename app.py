@@ -1,12 +1,20 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
-import csv
 import re
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.utils import get_column_letter
+import hashlib
+import importlib.util
+import xlsxwriter
+
+# Lecture des fichiers Excel par python-calamine (analyseur compilé) lorsqu'il est
+# installé, sinon par le moteur par défaut de pandas (openpyxl)
+excel_engine = 'calamine' if importlib.util.find_spec('python_calamine') is not None else None
+
+# Bornes des caches Streamlit, partagés par toutes les sessions du serveur : seuls les
+# fichiers les plus récents sont conservés, et chaque entrée expire au bout d'une heure
+CACHE_MAX_FICHIERS = 8
+CACHE_DUREE_SECONDES = 3600
 
 # Table de correspondance Diametre -> Lettre pour FP2E
 diametre_lettre = {
@@ -24,238 +32,580 @@ diametre_lettre = {
     150: ['K']
 }
 
-def get_csv_delimiter(file):
+# Colonnes indispensables aux contrôles
+COLONNES_REQUISES = ['Protocole Radio', 'Marque', 'Numéro de compteur', 'Numéro de tête', 'Latitude', 'Longitude', 'Année de fabrication', 'Diametre', 'Traité', 'Mode de relève']
+
+# Même table sous forme de matrice booléenne diamètre x lettre ('A' à 'Z'),
+# pour tester la conformité de toutes les lignes par simple indexation
+diametres_fp2e = np.array(sorted(diametre_lettre), dtype=float)
+lettres_autorisees = np.array(
+    [[chr(ord('A') + i) in diametre_lettre[diametre] for i in range(26)] for diametre in sorted(diametre_lettre)],
+    dtype=bool
+)
+
+def get_csv_delimiter(file_bytes):
     """
-    Détecte automatiquement le délimiteur d'un fichier CSV.
+    Détecte automatiquement le délimiteur d'un fichier CSV à partir de ses
+    premiers octets, parmi les délimiteurs usuels (',', ';', tabulation, '|').
     """
-    try:
-        sample = file.read(2048).decode('utf-8')
-        dialect = csv.Sniffer().sniff(sample)
-        file.seek(0)
-        return dialect.delimiter
-    except Exception:
-        file.seek(0)
-        return ','
-
-# --- Fonction de vérification FP2E modifiée pour plus de précision ---
-def check_fp2e_details(row):
+    # Un caractère multi-octets coupé en fin d'échantillon ne doit pas faire échouer la détection
+    sample = file_bytes[:2048].decode('utf-8', errors='replace')
+
+    # Fichier avec en-tête : le délimiteur est celui qui isole le plus de colonnes
+    # attendues dans la première ligne
+    en_tete = sample.lstrip('\ufeff').split('\n', 1)[0].rstrip('\r')
+    colonnes_reconnues = {
+        delimiter: len({champ.strip().strip('"') for champ in en_tete.split(delimiter)} & set(COLONNES_REQUISES))
+        for delimiter in ',;\t|'
+    }
+    meilleur_delimiter = max(colonnes_reconnues, key=colonnes_reconnues.get)
+    if colonnes_reconnues[meilleur_delimiter] > 0:
+        return meilleur_delimiter
+
+    # Sinon, le délimiteur le plus fréquent de la première ligne (',' à défaut)
+    occurrences = {delimiter: en_tete.count(delimiter) for delimiter in ',;\t|'}
+    meilleur_delimiter = max(occurrences, key=occurrences.get)
+    return meilleur_delimiter if occurrences[meilleur_delimiter] > 0 else ','
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_FICHIERS, ttl=CACHE_DUREE_SECONDES)
+def load_dataframe(file_hash, _file_bytes, file_extension):
     """
-    Vérifie les détails de la norme FP2E et renvoie une chaîne détaillée
-    du problème pour un coloriage précis.
+    Lit le contenu du fichier téléversé (CSV ou Excel) et renvoie le DataFrame
+    ainsi que le délimiteur CSV détecté (None pour un fichier Excel).
+    Le résultat est mis en cache sur l'empreinte SHA-256 du fichier : les
+    réexécutions du script Streamlit ne relisent pas le fichier.
     """
-    anomalies = []
-    
-    try:
-        compteur = str(row['Numéro de compteur']).strip()
-        annee_fabrication_val = str(row['Année de fabrication']).strip()
-        diametre_val = row['Diametre']
-        
-        # Vérification 1 : Format du compteur
-        fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
-        if not re.match(fp2e_regex, compteur):
-            anomalies.append('Format de compteur non FP2E')
-        else:
-            annee_compteur = compteur[1:3]
-            lettre_diam = compteur[4].upper()
-            
-            # Vérification 2 : Année de fabrication (millésime)
-            if annee_fabrication_val == '' or not annee_fabrication_val.isdigit():
-                anomalies.append('Année fabrication manquante ou invalide')
-            else:
-                annee_fabrication_padded = annee_fabrication_val.zfill(2)
-                if annee_compteur != annee_fabrication_padded:
-                    anomalies.append('Année millésime non conforme FP2E')
-                
-            # Vérification 3 : Diamètre
-            fp2e_map = {'A': 15, 'U': 15, 'V': 15, 'B': 20, 'C': 25, 'D': 30, 'E': 40, 'F': 50, 'G': [60, 65], 'H': 80, 'I': 100, 'J': 125, 'K': 150}
-            expected_diametres = fp2e_map.get(lettre_diam, [])
-            if not isinstance(expected_diametres, list):
-                expected_diametres = [expected_diametres]
-
-            if pd.isna(diametre_val) or diametre_val not in expected_diametres:
-                anomalies.append('Diamètre non conforme FP2E')
-
-    except (TypeError, ValueError, IndexError):
-        anomalies.append('Erreur de format interne')
-    
-    if not anomalies:
-        return 'Conforme'
-    else:
-        return ' / '.join(anomalies)
-
-
-def check_data(df):
+    # Définir le type de données pour les colonnes pour éviter la notation scientifique.
+    # Les colonnes texte contrôlées ont un type explicite, sans inférence ni perte des zéros
+    # de tête, pour un CSV comme pour un fichier Excel : les mêmes données donnent ainsi
+    # les mêmes anomalies quel que soit le format téléversé
+    dtype_mapping = {
+        'Numéro de branchement': str,
+        'Abonnement': str,
+        'Marque': str,
+        'Protocole Radio': str,
+        'Numéro de compteur': str,
+        'Numéro de tête': str,
+        'Traité': str,
+        'Mode de relève': str
+    }
+
+    buffer = io.BytesIO(_file_bytes)
+    if file_extension == 'csv':
+        delimiter = get_csv_delimiter(_file_bytes)
+        # Moteur C en une seule passe (low_memory=False) : le moteur 'pyarrow' de pandas
+        # applique les types après coup (zéros de tête perdus, None au lieu de NaN)
+        return pd.read_csv(buffer, sep=delimiter, dtype=dtype_mapping, low_memory=False), delimiter
+    return pd.read_excel(buffer, dtype=dtype_mapping, engine=excel_engine), None
+
+# Caractères refusés dans un nom de feuille Excel, compilés une seule fois à l'import du module
+CARACTERES_INTERDITS_FEUILLE = re.compile(r'[\\/?*\[\]:()\'"<>|]')
+
+# Format FP2E d'un numéro de compteur : 11 caractères, une lettre, deux chiffres
+# (millésime), deux lettres (dont la lettre de diamètre) puis six chiffres
+FP2E_LONGUEUR = 11
+FP2E_POSITIONS_LETTRES = [0, 3, 4]
+FP2E_POSITIONS_CHIFFRES = [1, 2, 5, 6, 7, 8, 9, 10]
+
+def format_fp2e_conforme(compteurs):
     """
-    Vérifie les données du DataFrame pour détecter les anomalies en utilisant des opérations vectorisées.
-    Retourne un DataFrame avec les lignes contenant des anomalies.
+    Indique pour chaque numéro de compteur s'il respecte le format FP2E, en comparant
+    les codes de caractères position par position sur une matrice lignes x 13.
     """
-    df_with_anomalies = df.copy()
-
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].apply(
-        lambda x: str(int(float(x))) if x.replace('.', '', 1).isdigit() and x != '' else x
+    # Chaque valeur devient 13 points de code UCS-4 contigus, complétés par des zéros :
+    # une chaîne de 11 caractères exactement a un 11e code non nul et un 12e code nul.
+    # Comme le '$' de l'expression régulière '^[A-Z]\d{2}[A-Z]{2}\d{6}$', un saut de ligne
+    # final est accepté : 12e code '\n', 13e code nul
+    codes = compteurs.to_numpy(dtype=object).astype(f'U{FP2E_LONGUEUR + 2}')
+    codes = codes.view(np.uint32).reshape(-1, FP2E_LONGUEUR + 2)
+    lettres = codes[:, FP2E_POSITIONS_LETTRES]
+    chiffres = codes[:, FP2E_POSITIONS_CHIFFRES]
+    fin_de_chaine = (codes[:, FP2E_LONGUEUR] == 0) | (codes[:, FP2E_LONGUEUR] == ord('\n'))
+    conforme = (
+        (codes[:, FP2E_LONGUEUR - 1] != 0) & fin_de_chaine & (codes[:, FP2E_LONGUEUR + 1] == 0)
+        & ((lettres >= ord('A')) & (lettres <= ord('Z'))).all(axis=1)
+        & ((chiffres >= ord('0')) & (chiffres <= ord('9'))).all(axis=1)
     )
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].str.slice(-2).str.zfill(2)
-    
-    # Vérification des colonnes requises
-    required_columns = ['Protocole Radio', 'Marque', 'Numéro de compteur', 'Numéro de tête', 'Latitude', 'Longitude', 'Année de fabrication', 'Diametre', 'Traité', 'Mode de relève']
-    if not all(col in df_with_anomalies.columns for col in required_columns):
-        missing = [col for col in required_columns if col not in df_with_anomalies.columns]
-        st.error(f"Colonnes requises manquantes : {', '.join(missing)}")
-        st.stop()
-
-    df_with_anomalies['Anomalie'] = ''
-    df_with_anomalies['Anomalie Détaillée FP2E'] = '' # Nouvelle colonne pour les détails FP2E
+    return pd.Series(conforme, index=compteurs.index)
 
-    # Conversion des colonnes pour les analyses et remplacement des NaN par des chaînes vides
-    df_with_anomalies['Numéro de compteur'] = df_with_anomalies['Numéro de compteur'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Numéro de tête'] = df_with_anomalies['Numéro de tête'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Marque'] = df_with_anomalies['Marque'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Protocole Radio'] = df_with_anomalies['Protocole Radio'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Traité'] = df_with_anomalies['Traité'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Mode de relève'] = df_with_anomalies['Mode de relève'].astype(str).replace('nan', '', regex=False)
-    
-    # Conversion des colonnes Latitude et Longitude en numérique pour éviter le TypeError
-    df_with_anomalies['Latitude'] = pd.to_numeric(df_with_anomalies['Latitude'], errors='coerce')
-    df_with_anomalies['Longitude'] = pd.to_numeric(df_with_anomalies['Longitude'], errors='coerce')
-
-    # Marqueurs pour les conditions
-    is_kamstrup = df_with_anomalies['Marque'].str.upper() == 'KAMSTRUP'
-    is_sappel = df_with_anomalies['Marque'].str.upper().isin(['SAPPEL (C)', 'SAPPEL (H)', 'SAPPEL(C)'])
-    is_itron = df_with_anomalies['Marque'].str.upper() == 'ITRON'
-    is_kaifa = df_with_anomalies['Marque'].str.upper() == 'KAIFA'
-    is_mode_manuelle = df_with_anomalies['Mode de relève'].str.upper() == 'MANUELLE'
-    is_mode_telerel = df_with_anomalies['Mode de relève'].str.upper() == 'TÉLERELEVE'
-
-    annee_fabrication_num = pd.to_numeric(df_with_anomalies['Année de fabrication'], errors='coerce')
-    df_with_anomalies['Diametre'] = pd.to_numeric(df_with_anomalies['Diametre'], errors='coerce')
+def evaluer_par_valeur_distincte(serie, test):
+    """
+    Applique un test vectorisé aux seules valeurs distinctes d'une colonne (ses catégories,
+    ou ses valeurs factorisées), puis diffuse le résultat à toutes les lignes par leurs
+    codes entiers.
+    """
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codes, valeurs = serie.cat.codes.to_numpy(), serie.cat.categories
+    else:
+        codes, valeurs = pd.factorize(serie)
+    resultat = np.asarray(test(pd.Series(valeurs, dtype=object)), dtype=bool)
+    # Code -1 (valeur manquante) : dernier élément, toujours faux
+    return pd.Series(np.append(resultat, False)[codes], index=serie.index)
 
+def texte_sans_nan(serie):
+    """
+    Convertit une colonne en texte, comme astype(str), la chaîne 'nan' devenant vide.
+    Pour une colonne de chaînes, le remplacement porte sur les seules valeurs distinctes,
+    recopiées ensuite sur les lignes. Toute autre colonne est convertie ligne par ligne :
+    des valeurs égales mais de types différents (True et 1, 1 et 1.0) n'ont pas le même texte.
+    """
+    def en_texte(valeurs):
+        # À partir de pandas 3, astype(str) conserve les valeurs manquantes : elles deviennent vides
+        return valeurs.astype(str).astype(object).fillna('').replace('nan', '', regex=False)
+
+    codes, valeurs = pd.factorize(serie)
+    if not all(isinstance(valeur, str) for valeur in valeurs):
+        return en_texte(serie)
+    valeurs = pd.Series(valeurs, dtype=object).replace('nan', '', regex=False).to_numpy(dtype=object)
+    texte = np.append(valeurs, '')[codes]
+    # Valeurs manquantes (code -1) : même texte que astype(str) ('None' pour None, '' pour NaN)
+    manquantes = codes == -1
+    if manquantes.any():
+        texte[manquantes] = en_texte(serie[manquantes]).to_numpy(dtype=object)
+    return pd.Series(texte, index=serie.index)
+
+# Nombre maximal de lignes en anomalie affichées dans la page
+NB_LIGNES_AFFICHEES = 500
+
+# Règles de contrôle : (libellé de l'anomalie, prédicat sur les colonnes préparées par check_data).
+# L'ordre de la table est celui des libellés dans la colonne 'Anomalie'.
+REGLES_ANOMALIES = [
     # ------------------------------------------------------------------
     # ANOMALIES GÉNÉRALES (valeurs manquantes et incohérences de base)
     # ------------------------------------------------------------------
-    
-    condition_protocole_manquant = (df_with_anomalies['Protocole Radio'].isin(['', 'nan'])) & (~is_mode_manuelle)
-    df_with_anomalies.loc[condition_protocole_manquant, 'Anomalie'] += 'Protocole Radio manquant / '
-    
-    df_with_anomalies.loc[df_with_anomalies['Marque'].isin(['', 'nan']), 'Anomalie'] += 'Marque manquante / '
-    df_with_anomalies.loc[df_with_anomalies['Numéro de compteur'].isin(['', 'nan']), 'Anomalie'] += 'Numéro de compteur manquant / '
-    df_with_anomalies.loc[df_with_anomalies['Diametre'].isnull(), 'Anomalie'] += 'Diamètre manquant / '
-    df_with_anomalies.loc[annee_fabrication_num.isnull(), 'Anomalie'] += 'Année de fabrication manquante / '
-    
-    # CORRECTION DÉFINITIVE : La condition a été simplifiée pour une meilleure lisibilité et correction.
-    # L'anomalie est levée si le Numéro de tête est manquant
+    ('Protocole Radio manquant', lambda c: c['protocole_vide'] & ~c['is_mode_manuelle']),
+    ('Marque manquante', lambda c: c['marque_vide']),
+    ('Numéro de compteur manquant', lambda c: c['compteur_vide']),
+    ('Diamètre manquant', lambda c: c['diametre'].isnull()),
+    ('Année de fabrication manquante', lambda c: c['annee_num'].isnull()),
+    # CORRECTION DÉFINITIVE : L'anomalie est levée si le Numéro de tête est manquant
     # ET la marque n'est pas KAMSTRUP, ET le mode n'est pas Manuel,
     # ET la marque n'est pas KAIFA.
     # Note : Il est implicite que KAIFA en mode Manuel ou Télérève n'aura pas cette anomalie.
-    condition_tete_manquante = (df_with_anomalies['Numéro de tête'].isin(['', 'nan'])) & (~is_kamstrup) & (~is_mode_manuelle) & (~is_kaifa)
-    df_with_anomalies.loc[condition_tete_manquante, 'Anomalie'] += 'Numéro de tête manquant / '
-
-    df_with_anomalies.loc[df_with_anomalies['Latitude'].isnull() | df_with_anomalies['Longitude'].isnull(), 'Anomalie'] += 'Coordonnées GPS non numériques / '
-    coord_invalid = ((df_with_anomalies['Latitude'] == 0) | (~df_with_anomalies['Latitude'].between(-90, 90))) | \
-                    ((df_with_anomalies['Longitude'] == 0) | (~df_with_anomalies['Longitude'].between(-180, 180)))
-    df_with_anomalies.loc[coord_invalid, 'Anomalie'] += 'Coordonnées GPS invalides / '
+    ('Numéro de tête manquant', lambda c: c['tete_vide'] & ~c['is_kamstrup'] & ~c['is_mode_manuelle'] & ~c['is_kaifa']),
+    ('Coordonnées GPS non numériques', lambda c: c['gps_non_numerique']),
+    ('Coordonnées GPS invalides', lambda c: c['gps_invalide']),
 
     # ------------------------------------------------------------------
     # ANOMALIES SPÉCIFIQUES AUX MARQUES
     # ------------------------------------------------------------------
-    
-    # KAMSTRUP
-    kamstrup_valid = is_kamstrup & (~df_with_anomalies['Numéro de tête'].isin(['', 'nan']))
-    df_with_anomalies.loc[is_kamstrup & (df_with_anomalies['Numéro de compteur'].str.len() != 8), 'Anomalie'] += 'KAMSTRUP: Compteur ≠ 8 caractères / '
-    df_with_anomalies.loc[kamstrup_valid & (df_with_anomalies['Numéro de compteur'] != df_with_anomalies['Numéro de tête']), 'Anomalie'] += 'KAMSTRUP: Compteur ≠ Tête / '
-    df_with_anomalies.loc[kamstrup_valid & (~df_with_anomalies['Numéro de compteur'].str.isdigit() | ~df_with_anomalies['Numéro de tête'].str.isdigit()), 'Anomalie'] += 'KAMSTRUP: Compteur ou Tête non numérique / '
-    diametre_kamstrup_anomalie = is_kamstrup & (~df_with_anomalies['Diametre'].between(15, 80))
-    df_with_anomalies.loc[diametre_kamstrup_anomalie, 'Anomalie'] += 'KAMSTRUP: Diamètre hors de la plage [15, 80] / '
-
-    # SAPPEL
-    sappel_valid = is_sappel & (~df_with_anomalies['Numéro de tête'].isin(['', 'nan']))
-    df_with_anomalies.loc[sappel_valid & (df_with_anomalies['Numéro de tête'].str.len() != 16), 'Anomalie'] += 'SAPPEL: Tête ≠ 16 caractères / '
-    
-    # Correction pour SAPPEL C
-    df_with_anomalies.loc[(is_sappel) & (df_with_anomalies['Numéro de compteur'].str.startswith('C', na=False)) & (df_with_anomalies['Marque'].str.upper() != 'SAPPEL (C)'), 'Anomalie'] += 'SAPPEL: Incohérence Marque/Compteur (C) / '
-    
-    df_with_anomalies.loc[(is_sappel) & (df_with_anomalies['Numéro de compteur'].str.startswith('H', na=False)) & (df_with_anomalies['Marque'].str.upper() != 'SAPPEL (H)'), 'Anomalie'] += 'SAPPEL: Incohérence Marque/Compteur (H) / '
-    
-    # ITRON
-    itron_valid = is_itron & (~df_with_anomalies['Numéro de tête'].isin(['', 'nan']))
-    df_with_anomalies.loc[itron_valid & (df_with_anomalies['Numéro de tête'].str.len() != 8), 'Anomalie'] += 'ITRON: Tête ≠ 8 caractères / '
-    
+    ('KAMSTRUP: Compteur ≠ 8 caractères', lambda c: c['is_kamstrup'] & (c['longueur_compteur'] != 8)),
+    ('KAMSTRUP: Compteur ≠ Tête', lambda c: c['is_kamstrup'] & ~c['tete_vide'] & (c['compteur'] != c['tete'])),
+    ('KAMSTRUP: Compteur ou Tête non numérique', lambda c: c['is_kamstrup'] & ~c['tete_vide'] & (~c['compteur_numerique'] | ~c['tete_numerique'])),
+    ('KAMSTRUP: Diamètre hors de la plage [15, 80]', lambda c: c['is_kamstrup'] & ~c['diametre'].between(15, 80)),
+    ('SAPPEL: Tête ≠ 16 caractères', lambda c: c['is_sappel'] & ~c['tete_vide'] & (c['longueur_tete'] != 16)),
+    ('SAPPEL: Incohérence Marque/Compteur (C)', lambda c: c['is_sappel'] & (c['premier_caractere'] == 'C') & ~c['is_sappel_c']),
+    ('SAPPEL: Incohérence Marque/Compteur (H)', lambda c: c['is_sappel'] & (c['premier_caractere'] == 'H') & ~c['is_sappel_h']),
+    ('ITRON: Tête ≠ 8 caractères', lambda c: c['is_itron'] & ~c['tete_vide'] & (c['longueur_tete'] != 8)),
+
     # ------------------------------------------------------------------
-    # ANOMALIES MULTI-COLONNES (logique consolidée)
+    # ANOMALIES MULTI-COLONNES : Protocole Radio vs Traité, uniquement si le protocole est renseigné
     # ------------------------------------------------------------------
-    # Ajout de la condition pour vérifier que Protocole Radio n'est pas vide
-    is_protocole_radio_filled = ~df_with_anomalies['Protocole Radio'].isin(['', 'nan'])
-    
-    # Protocole Radio vs Traité
-    traite_lra_condition = df_with_anomalies['Traité'].str.startswith(('903', '863'), na=False)
-    condition_radio_lra = traite_lra_condition & (df_with_anomalies['Protocole Radio'].str.upper() != 'LRA') & (~is_mode_manuelle) & is_protocole_radio_filled
-    df_with_anomalies.loc[condition_radio_lra, 'Anomalie'] += 'Protocole ≠ LRA pour Traité 903/863 / '
-    
-    condition_radio_sgx = (~traite_lra_condition) & (df_with_anomalies['Protocole Radio'].str.upper() != 'SGX') & (~is_mode_manuelle) & is_protocole_radio_filled
-    df_with_anomalies.loc[condition_radio_sgx, 'Anomalie'] += 'Protocole ≠ SGX pour Traité non 903/863 / '
+    ('Protocole ≠ LRA pour Traité 903/863', lambda c: c['traite_lra'] & c['protocole_inattendu']),
+    ('Protocole ≠ SGX pour Traité non 903/863', lambda c: ~c['traite_lra'] & c['protocole_inattendu']),
+
+    # ------------------------------------------------------------------
+    # NORME FP2E : format, millésime et diamètre, pour les lignes soumises au contrôle FP2E
+    # ------------------------------------------------------------------
+    ('Format de compteur non FP2E', lambda c: c['fp2e_format_non_conforme']),
+    ('Année fabrication manquante ou invalide', lambda c: c['fp2e_annee_invalide']),
+    ('Année millésime non conforme FP2E', lambda c: c['fp2e_millesime_different']),
+    ('Diamètre non conforme FP2E', lambda c: c['fp2e_diametre_non_conforme']),
+
+    # ------------------------------------------------------------------
+    # LOGIQUE DEMANDÉE : La règle "I" ou "D" pour ITRON et "C" ou "H" pour SAPPEL,
+    # UNIQUEMENT pour les compteurs manuels dont le format FP2E est respecté
+    # ------------------------------------------------------------------
+    ('ITRON manuel: doit commencer par "I" ou "D"', lambda c: c['is_mode_manuelle'] & c['is_itron'] & c['is_fp2e_compliant'] & ~c['premier_caractere_minuscule'].isin(['i', 'd'])),
+    ('SAPPEL manuel: doit commencer par "C" ou "H"', lambda c: c['is_mode_manuelle'] & c['is_sappel'] & c['is_fp2e_compliant'] & ~c['premier_caractere_minuscule'].isin(['c', 'h'])),
+]
+
+def resultat_sans_anomalie(df):
+    """
+    Renvoie le résultat de check_data pour un fichier sans anomalie : un DataFrame
+    d'anomalies vide, avec les colonnes du fichier, et un compteur vide.
+    """
+    anomalies_df = df.iloc[:0].assign(**{'Anomalie': '', 'Anomalie Détaillée FP2E': ''})
+    anomalies_df = anomalies_df.reset_index().rename(columns={'index': 'Index original'})
+    return anomalies_df, pd.Series(dtype='int64')
+
+def check_data(df):
+    """
+    Vérifie les données du DataFrame pour détecter les anomalies en utilisant des opérations vectorisées.
+    Retourne un DataFrame avec les lignes contenant des anomalies.
+    """
+    # Vérification des colonnes requises
+    required_columns = COLONNES_REQUISES
+    colonnes_presentes = set(df.columns)
+    missing = [col for col in required_columns if col not in colonnes_presentes]
+    if missing:
+        st.error(f"Colonnes requises manquantes : {', '.join(missing)}")
+        st.stop()
+
+    # Fichier sans ligne : aucune règle à évaluer. Des colonnes requises entièrement vides
+    # ne permettent pas de sortie anticipée : chaque ligne lève alors les anomalies de
+    # valeurs manquantes, qui doivent figurer dans le résultat
+    if df.empty:
+        return resultat_sans_anomalie(df)
+
+    # Le DataFrame d'entrée n'est ni copié ni modifié : les colonnes contrôlées sont
+    # normalisées dans un DataFrame de travail qui partage son index, et les autres
+    # colonnes du fichier sont rattachées aux seules lignes en anomalie à la fin
+    df_with_anomalies = pd.DataFrame(index=df.index)
+
+    # L'année est convertie en texte sur toute la colonne (une date lue depuis Excel garde
+    # ainsi le texte de astype(str)), puis normalisée (entier sans décimale, deux derniers
+    # chiffres) et convertie en nombre sur ses seules valeurs distinctes
+    codes_annee, annees = pd.factorize(texte_sans_nan(df['Année de fabrication']))
+    annees = pd.Series(annees, dtype=object).apply(
+        lambda x: str(int(float(x))) if x.replace('.', '', 1).isdigit() and x != '' else x
+    )
+    annees = annees.str.slice(-2).str.zfill(2)
+    df_with_anomalies['Année de fabrication'] = pd.Series(annees.to_numpy(dtype=object)[codes_annee], index=df.index)
+    annee_fabrication_num = pd.Series(
+        pd.to_numeric(annees, errors='coerce').to_numpy()[codes_annee], index=df.index
+    )
+
+    # Conversion des colonnes pour les analyses et remplacement des NaN par des chaînes vides
+    df_with_anomalies['Numéro de compteur'] = texte_sans_nan(df['Numéro de compteur'])
+    df_with_anomalies['Numéro de tête'] = texte_sans_nan(df['Numéro de tête'])
+    df_with_anomalies['Marque'] = texte_sans_nan(df['Marque'])
+    df_with_anomalies['Protocole Radio'] = texte_sans_nan(df['Protocole Radio'])
+    df_with_anomalies['Traité'] = texte_sans_nan(df['Traité'])
+    df_with_anomalies['Mode de relève'] = texte_sans_nan(df['Mode de relève'])
+
+    # Colonnes à faible cardinalité : le type 'category' ramène les comparaisons
+    # et les opérations .str à un calcul sur les seules catégories distinctes
+    for col in ['Marque', 'Protocole Radio', 'Traité']:
+        df_with_anomalies[col] = df_with_anomalies[col].astype('category')
+
+    # Conversion des colonnes Latitude et Longitude en numérique pour éviter le TypeError :
+    # une seule conversion par colonne, dont dérivent tous les contrôles GPS
+    latitude = pd.to_numeric(df['Latitude'], errors='coerce')
+    longitude = pd.to_numeric(df['Longitude'], errors='coerce')
+    df_with_anomalies['Latitude'] = latitude
+    df_with_anomalies['Longitude'] = longitude
+    lat = latitude.to_numpy(dtype=float)
+    lon = longitude.to_numpy(dtype=float)
+
+    df_with_anomalies['Diametre'] = pd.to_numeric(df['Diametre'], errors='coerce')
+
+    # Valeurs manquantes des colonnes d'identification, évaluées en une seule opération sur le bloc de colonnes
+    valeurs_vides = df_with_anomalies[['Protocole Radio', 'Marque', 'Numéro de compteur', 'Numéro de tête']].isin(['', 'nan'])
+
+    # Les numéros et l'année sont analysés sous forme de chaînes Arrow : longueurs, préfixes,
+    # comparaisons et découpages s'exécutent alors sur des tampons contigus et non plus objet
+    # par objet. Les colonnes restituées dans le résultat gardent leur type d'origine.
+    compteur = df_with_anomalies['Numéro de compteur'].astype('string[pyarrow]')
+    tete = df_with_anomalies['Numéro de tête'].astype('string[pyarrow]')
+    annee = df_with_anomalies['Année de fabrication'].astype('string[pyarrow]')
+    premier_caractere = compteur.str.slice(0, 1)
+
+    # Colonnes et marqueurs calculés une seule fois, partagés par toutes les règles de REGLES_ANOMALIES
+    # Les tests sur la marque, le mode de relève, le protocole et le Traité portent sur
+    # leurs quelques valeurs distinctes, puis sont diffusés aux lignes par codes entiers
+    marque = df_with_anomalies['Marque']
+    colonnes = {
+        'compteur': compteur,
+        'tete': tete,
+        'diametre': df_with_anomalies['Diametre'],
+        'annee_num': annee_fabrication_num,
+        'gps_non_numerique': pd.Series(np.isnan(lat) | np.isnan(lon), index=df_with_anomalies.index),
+        # Une valeur non numérique (NaN) échoue aussi aux tests de plage, comme avec between()
+        'gps_invalide': pd.Series(
+            (lat == 0) | ~(np.abs(lat) <= 90) | (lon == 0) | ~(np.abs(lon) <= 180),
+            index=df_with_anomalies.index
+        ),
+        'protocole_vide': valeurs_vides['Protocole Radio'],
+        'marque_vide': valeurs_vides['Marque'],
+        'compteur_vide': valeurs_vides['Numéro de compteur'],
+        'tete_vide': valeurs_vides['Numéro de tête'],
+        'is_kamstrup': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper() == 'KAMSTRUP'),
+        'is_sappel': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper().isin(['SAPPEL (C)', 'SAPPEL (H)', 'SAPPEL(C)'])),
+        'is_sappel_c': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper() == 'SAPPEL (C)'),
+        'is_sappel_h': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper() == 'SAPPEL (H)'),
+        'is_itron': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper() == 'ITRON'),
+        'is_kaifa': evaluer_par_valeur_distincte(marque, lambda v: v.str.upper() == 'KAIFA'),
+        'is_mode_manuelle': evaluer_par_valeur_distincte(df_with_anomalies['Mode de relève'], lambda v: v.str.upper() == 'MANUELLE'),
+        'longueur_compteur': compteur.str.len(),
+        'longueur_tete': tete.str.len(),
+        'compteur_numerique': compteur.str.isdigit(),
+        # Les règles de préfixe ne lisent que le premier caractère du compteur,
+        # extrait une seule fois au lieu d'un startswith ou d'un lower par règle
+        'premier_caractere': premier_caractere,
+        'premier_caractere_minuscule': premier_caractere.str.lower(),
+        'tete_numerique': tete.str.isdigit(),
+        'traite_lra': evaluer_par_valeur_distincte(df_with_anomalies['Traité'], lambda v: v.str.startswith(('903', '863'), na=False)),
+    }
+
+    # Protocole attendu selon le Traité (LRA pour 903/863, SGX sinon), confronté en une
+    # seule sélection au protocole renseigné, hors relève manuelle
+    protocole = df_with_anomalies['Protocole Radio']
+    est_lra = evaluer_par_valeur_distincte(protocole, lambda v: v.str.upper() == 'LRA')
+    est_sgx = evaluer_par_valeur_distincte(protocole, lambda v: v.str.upper() == 'SGX')
+    protocole_inattendu = np.where(colonnes['traite_lra'], ~est_lra, ~est_sgx)
+    colonnes['protocole_inattendu'] = protocole_inattendu & ~colonnes['is_mode_manuelle'] & ~colonnes['protocole_vide']
 
     # ------------------------------------------------------------------
     # LOGIQUE CORRIGÉE POUR LA NORME FP2E
     # ------------------------------------------------------------------
     
-    # Condition pour appliquer la vérification FP2E
-    fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
+    # Le format FP2E est évalué une seule fois sur toute la colonne, puis réutilisé
+    colonnes['is_fp2e_compliant'] = format_fp2e_conforme(df_with_anomalies['Numéro de compteur'])
     
-    sappel_itron_non_manuelle = (is_sappel | is_itron) & (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    manuelle_format_ok = (df_with_anomalies['Mode de relève'].str.upper() == 'MANUELLE') & (df_with_anomalies['Numéro de compteur'].str.match(fp2e_regex, na=False))
+    sappel_itron_non_manuelle = (colonnes['is_sappel'] | colonnes['is_itron']) & (~colonnes['is_mode_manuelle'])
+    manuelle_format_ok = colonnes['is_mode_manuelle'] & colonnes['is_fp2e_compliant']
     
     fp2e_check_condition = sappel_itron_non_manuelle | manuelle_format_ok
     
-    fp2e_results = df_with_anomalies[fp2e_check_condition].apply(check_fp2e_details, axis=1)
-    
-    # Mise à jour des colonnes d'anomalies
-    for index, result in fp2e_results.items():
-        if 'Format de compteur non FP2E' in result:
-            df_with_anomalies.loc[index, 'Anomalie'] += 'Format de compteur non FP2E / '
-        if 'Année fabrication manquante ou invalide' in result:
-            df_with_anomalies.loc[index, 'Anomalie'] += 'Année fabrication manquante ou invalide / '
-        if 'Année millésime non conforme FP2E' in result:
-            df_with_anomalies.loc[index, 'Anomalie'] += 'Année millésime non conforme FP2E / '
-        if 'Diamètre non conforme FP2E' in result:
-            df_with_anomalies.loc[index, 'Anomalie'] += 'Diamètre non conforme FP2E / '
-    
-    # ------------------------------------------------------------------
-    # LOGIQUE DEMANDÉE : La règle "I" ou "D" pour ITRON et "C" ou "H" pour SAPPEL
-    # pour les compteurs manuels FP2E
-    # ------------------------------------------------------------------
-    # On vérifie si le format FP2E est respecté en utilisant la regex
-    is_fp2e_compliant = df_with_anomalies['Numéro de compteur'].str.match(fp2e_regex, na=False)
-    
-    # On applique la règle ITRON UNIQUEMENT si le mode est manuel, la marque est ITRON et le format FP2E est respecté
-    itron_manuelle_fp2e_condition = is_mode_manuelle & is_itron & is_fp2e_compliant
-    df_with_anomalies.loc[itron_manuelle_fp2e_condition & (~df_with_anomalies['Numéro de compteur'].str.lower().str.startswith(('i', 'd'), na=False)), 'Anomalie'] += 'ITRON manuel: doit commencer par "I" ou "D" / '
-    
-    # On applique la règle SAPPEL UNIQUEMENT si le mode est manuel, la marque est SAPPEL et le format FP2E est respecté
-    sappel_manuelle_fp2e_condition = is_mode_manuelle & is_sappel & is_fp2e_compliant
-    df_with_anomalies.loc[sappel_manuelle_fp2e_condition & (~df_with_anomalies['Numéro de compteur'].str.lower().str.startswith(('c', 'h'), na=False)), 'Anomalie'] += 'SAPPEL manuel: doit commencer par "C" ou "H" / '
+    # Les contrôles FP2E portent sur le numéro de compteur débarrassé des espaces superflus
+    # Seul le format des numéros modifiés par le strip est réévalué : les autres sont
+    # identiques au numéro brut et reprennent le résultat de is_fp2e_compliant
+    compteur_fp2e = compteur.str.strip()
+    fp2e_format_conforme = colonnes['is_fp2e_compliant'].copy()
+    numero_modifie = (compteur_fp2e != compteur).to_numpy(dtype=bool, na_value=False)
+    if numero_modifie.any():
+        fp2e_format_conforme[numero_modifie] = format_fp2e_conforme(compteur_fp2e[numero_modifie]).to_numpy()
+    colonnes['fp2e_format_non_conforme'] = fp2e_check_condition & ~fp2e_format_conforme
+    fp2e_format_ok = fp2e_check_condition & fp2e_format_conforme
+
+    # Millésime : les chiffres 2 et 3 du compteur sont comparés à l'année sur deux chiffres,
+    # en une passe sur les colonnes, pour les lignes FP2E dont le format est respecté
+    annee_fp2e = annee.str.strip()
+    annee_valide = (annee_fp2e != '') & annee_fp2e.str.isdigit()
+    colonnes['fp2e_annee_invalide'] = fp2e_format_ok & ~annee_valide
+    colonnes['fp2e_millesime_different'] = fp2e_format_ok & annee_valide & (compteur_fp2e.str.slice(1, 3) != annee_fp2e.str.zfill(2))
+
+    # Diamètre : le couple (Diametre, 5e caractère du compteur) doit être autorisé dans
+    # lettres_autorisees ; le diamètre est retrouvé par recherche dichotomique et la lettre
+    # par son code de caractère, puis la table est lue d'un seul accès indexé
+    diametre = df_with_anomalies['Diametre'].to_numpy(dtype=float)
+    indice_diametre = np.searchsorted(diametres_fp2e, diametre).clip(max=len(diametres_fp2e) - 1)
+    diametre_connu = diametres_fp2e[indice_diametre] == diametre
+    lettre = compteur_fp2e.str.slice(4, 5).str.upper().fillna('').to_numpy(dtype=object).astype('U1')
+    indice_lettre = lettre.view(np.uint32).astype(np.int64) - ord('A')
+    lettre_connue = (indice_lettre >= 0) & (indice_lettre < 26)
+    couple_conforme = diametre_connu & lettre_connue & lettres_autorisees[indice_diametre, indice_lettre.clip(0, 25)]
+    colonnes['fp2e_diametre_non_conforme'] = fp2e_format_ok & ~couple_conforme
+
+    # Construction de la colonne 'Anomalie' : chaque règle occupe un bit d'un entier
+    # non signé de 64 bits par ligne (la table compte moins de 64 règles)
+    libelles = [libelle for libelle, _ in REGLES_ANOMALIES]
+    bits = np.zeros(len(df_with_anomalies), dtype=np.uint64)
+    for position, (_, predicat) in enumerate(REGLES_ANOMALIES):
+        masque = predicat(colonnes).to_numpy(dtype=bool, na_value=False)
+        bits |= masque.astype(np.uint64) << np.uint64(position)
+    lignes_en_anomalie = bits != 0
+
+    # Fichier conforme : ni libellés à construire ni lignes à recopier
+    if not lignes_en_anomalie.any():
+        return resultat_sans_anomalie(df)
+
+    # Les libellés sont joints une seule fois par combinaison distincte de règles,
+    # puis recopiés sur chaque ligne qui présente cette combinaison
+    combinaisons, combinaison_par_ligne = np.unique(bits[lignes_en_anomalie], return_inverse=True)
+    libelles_par_combinaison = np.array(
+        [' / '.join(libelle for position, libelle in enumerate(libelles) if int(combinaison) >> position & 1)
+         for combinaison in combinaisons],
+        dtype=object
+    )
 
-    # Nettoyage de la colonne 'Anomalie'
-    df_with_anomalies['Anomalie'] = df_with_anomalies['Anomalie'].str.strip().str.rstrip(' /')
-    
-    anomalies_df = df_with_anomalies[df_with_anomalies['Anomalie'] != ''].copy()
+    anomalies_df = df[lignes_en_anomalie].copy()
+    for col in required_columns:
+        anomalies_df[col] = df_with_anomalies.loc[lignes_en_anomalie, col]
+    anomalies_df['Anomalie'] = pd.Series(
+        libelles_par_combinaison[combinaison_par_ligne.ravel()],
+        index=anomalies_df.index, dtype=object
+    )
+    anomalies_df['Anomalie Détaillée FP2E'] = '' # Nouvelle colonne pour les détails FP2E
     anomalies_df.reset_index(inplace=True)
     anomalies_df.rename(columns={'index': 'Index original'}, inplace=True)
     
-    # Comptage des anomalies pour le résumé
-    anomaly_counter = anomalies_df['Anomalie'].str.split(' / ').explode().value_counts()
+    # Comptage des anomalies pour le résumé : nombre de lignes dont le bit de la règle est levé
+    anomaly_counter = pd.Series(
+        [np.count_nonzero(bits & np.uint64(1 << position)) for position in range(len(libelles))],
+        index=libelles, dtype='int64'
+    )
+    anomaly_counter = anomaly_counter[anomaly_counter > 0].sort_values(ascending=False, kind='stable')
     
     return anomalies_df, anomaly_counter
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_FICHIERS, ttl=CACHE_DUREE_SECONDES)
+def check_file(file_hash, _df):
+    """
+    Renvoie le résultat de check_data mis en cache sur l'empreinte SHA-256 du fichier
+    téléversé. Le DataFrame n'est pas haché : au-delà de 50 000 lignes, Streamlit n'en
+    hacherait qu'un échantillon, et deux fichiers différents pourraient partager un résultat.
+    """
+    return check_data(_df)
+
 def afficher_resume_anomalies(anomaly_counter):
     """
     Affiche un résumé des anomalies.
     """
     if not anomaly_counter.empty:
-        summary_df = pd.DataFrame(anomaly_counter).reset_index()
-        summary_df.columns = ["Type d'anomalie", "Nombre de cas"]
+        summary_df = pd.DataFrame({"Type d'anomalie": anomaly_counter.index, "Nombre de cas": anomaly_counter.to_numpy()})
         st.subheader("Récapitulatif des anomalies")
         st.dataframe(summary_df)
 
+def write_anomaly_sheet(ws, anomalies_df, anomaly_columns_map, header_format, red_format):
+    """
+    Écrit les lignes en anomalie dans une feuille xlsxwriter, ligne par ligne et dans
+    l'ordre, en surlignant en rouge les cellules concernées par chaque anomalie.
+    """
+    anomalies_df_display = anomalies_df.drop(columns=['Anomalie Détaillée FP2E'])
+    columns = list(anomalies_df_display.columns)
+
+    ws.write_row(0, 0, columns, header_format)
+
+    # Largeur de chaque colonne : plus longue valeur écrite (cellules vides exclues),
+    # mesurée colonne par colonne sur le DataFrame et non cellule par cellule
+    widths = []
+    for col, serie in anomalies_df_display.items():
+        longueurs = serie.dropna().astype(object).astype(str).str.len()
+        widths.append(max(len(str(col)), int(longueurs.max()) if len(longueurs) else 0))
+
+    # Les cellules à surligner ne dépendent que des libellés de la ligne : la mise en forme
+    # de chaque colonne est déterminée avant l'écriture, une fois par combinaison distincte
+    # d'anomalies, puis chaque ligne reprend la liste de formats de sa combinaison
+    combination_by_row, combinations = pd.factorize(
+        pd.MultiIndex.from_arrays([anomalies_df['Anomalie'], anomalies_df['Anomalie Détaillée FP2E']])
+    )
+    formats_by_combination = []
+    for anomalie, anomalie_fp2e in combinations:
+        anomalies = str(anomalie).split(' / ')
+        highlighted_columns = set()
+
+        # Logique de coloriage pour FP2E
+        fp2e_anomalies = [a for a in anomalies if 'FP2E' in a]
+        if fp2e_anomalies:
+            fp2e_details = str(anomalie_fp2e).split(' / ')
+
+            if 'Année fabrication différente' in fp2e_details or 'Année fabrication manquante ou invalide' in fp2e_details or 'Année millésime non conforme FP2E' in fp2e_details:
+                highlighted_columns.add('Année de fabrication')
+
+            if 'Diamètre non conforme FP2E' in fp2e_details:
+                highlighted_columns.add('Diametre')
+
+            if 'Format de compteur non FP2E' in fp2e_details or 'Erreur de format interne' in fp2e_details:
+                highlighted_columns.add('Numéro de compteur')
+
+        # Autres anomalies
+        for anomaly in anomalies:
+            anomaly_key = anomaly.strip()
+            if anomaly_key in anomaly_columns_map:
+                highlighted_columns.update(anomaly_columns_map[anomaly_key])
+
+        formats_by_combination.append([red_format if col in highlighted_columns else None for col in columns])
+
+    rows = zip(combination_by_row, anomalies_df_display.itertuples(index=False, name=None))
+    for row_num, (combination, row_data) in enumerate(rows, start=1):
+        cell_formats = formats_by_combination[combination]
+        for col_index, value in enumerate(row_data):
+            cell_format = cell_formats[col_index]
+            if pd.isna(value):
+                # Cellule vide : seule la mise en forme éventuelle est écrite
+                ws.write_blank(row_num, col_index, None, cell_format)
+                continue
+            ws.write(row_num, col_index, value, cell_format)
+
+    for col_index, width in enumerate(widths):
+        ws.set_column(col_index, col_index, width + 2)
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_FICHIERS, ttl=CACHE_DUREE_SECONDES)
+def build_csv_report(file_hash, _anomalies_df, delimiter):
+    """
+    Renvoie les lignes en anomalie au format CSV, avec le délimiteur du fichier d'origine.
+    Le contenu est mis en cache sur l'empreinte du fichier, comme le rapport Excel.
+    """
+    # Écriture directe en octets UTF-8 : pas de chaîne intermédiaire à ré-encoder
+    csv_buffer = io.BytesIO()
+    _anomalies_df.drop(columns=['Anomalie Détaillée FP2E']).to_csv(csv_buffer, index=False, sep=delimiter, encoding='utf-8')
+    return csv_buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_FICHIERS, ttl=CACHE_DUREE_SECONDES)
+def build_excel_report(file_hash, _anomalies_df, _anomaly_counter, anomaly_columns_map):
+    """
+    Construit le rapport Excel mis en forme (récapitulatif, toutes les anomalies et une
+    feuille par type d'anomalie) et renvoie son contenu en octets. Le rapport est mis en
+    cache sur l'empreinte du fichier : les réexécutions du script, dont celle déclenchée
+    par le bouton de téléchargement, ne reconstruisent pas le classeur.
+    """
+    anomalies_df, anomaly_counter = _anomalies_df, _anomaly_counter
+    excel_buffer_styled = io.BytesIO()
+
+    # xlsxwriter en mode 'constant_memory' : chaque ligne est envoyée sur disque dès
+    # qu'elle est écrite, sans arbre de cellules en mémoire. Les lignes d'une feuille
+    # doivent donc être écrites dans l'ordre, avec leur mise en forme définitive.
+    wb = xlsxwriter.Workbook(excel_buffer_styled, {
+        'constant_memory': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'default_date_format': 'dd/mm/yyyy',
+        'remove_timezone': True,
+        'nan_inf_to_errors': True,
+    })
+
+    header_format = wb.add_format({'bold': True})
+    red_format = wb.add_format({'bg_color': '#FFC7CE', 'pattern': 1})
+    title_format = wb.add_format({'bold': True, 'font_size': 16})
+    link_format = wb.add_format({'underline': 1, 'font_color': '#0563C1'})
+    right_format = wb.add_format({'align': 'right'})
+
+    ws_summary = wb.add_worksheet("Récapitulatif")
+
+    ws_all_anomalies = wb.add_worksheet("Toutes_Anomalies")
+    write_anomaly_sheet(ws_all_anomalies, anomalies_df, anomaly_columns_map, header_format, red_format)
+
+    ws_summary.write(0, 0, "Récapitulatif des anomalies", title_format)
+    ws_summary.write_row(2, 0, ["Type d'anomalie", "Nombre de cas"], header_format)
+
+    created_sheet_names = set(["Récapitulatif", "Toutes_Anomalies"])
+
+    ws_summary.write_url(3, 0, "internal:'Toutes_Anomalies'!A1", link_format, "Toutes les anomalies")
+    ws_summary.write(3, 1, len(anomalies_df), right_format)
+
+    # Les libellés ne sont séparés qu'une fois par combinaison distincte ;
+    # chaque feuille sélectionne ensuite ses lignes via les codes de combinaison
+    combinaison_par_ligne, combinaisons = pd.factorize(anomalies_df['Anomalie'])
+    libelles_par_combinaison = [set(combinaison.split(' / ')) for combinaison in combinaisons]
+
+    for r_idx, (anomaly_type, count) in enumerate(anomaly_counter.items()):
+        # Logique pour raccourcir le nom de la feuille
+        sheet_name_base = anomaly_type
+        sheet_name = CARACTERES_INTERDITS_FEUILLE.sub('', sheet_name_base)
+        sheet_name = sheet_name.replace(' ', '_').replace('.', '').replace(':', '_').strip()
+        if len(sheet_name) > 31:
+            sheet_name = sheet_name[:31].rstrip('_').strip()
+
+        original_sheet_name = sheet_name
+        counter = 1
+        while sheet_name in created_sheet_names:
+            sheet_name = f"{original_sheet_name[:28]}_{counter}"
+            counter += 1
+        created_sheet_names.add(sheet_name)
+
+        ws_anomaly_detail = wb.add_worksheet(sheet_name)
+
+        combinaison_concernee = np.array([anomaly_type in libelles for libelles in libelles_par_combinaison], dtype=bool)
+        filtered_df = anomalies_df[combinaison_concernee[combinaison_par_ligne]]
+        write_anomaly_sheet(ws_anomaly_detail, filtered_df, anomaly_columns_map, header_format, red_format)
+
+        row_num = 4 + r_idx
+        ws_summary.write_url(row_num, 0, f"internal:'{sheet_name}'!A1", link_format, anomaly_type)
+        ws_summary.write(row_num, 1, count)
+
+    summary_widths = [
+        max(len(value) for value in ["Récapitulatif des anomalies", "Type d'anomalie", "Toutes les anomalies", *anomaly_counter.index]),
+        max(len(str(value)) for value in ["Nombre de cas", len(anomalies_df), *anomaly_counter.values]),
+    ]
+    for col_index, width in enumerate(summary_widths):
+        ws_summary.set_column(col_index, col_index, width + 2)
+
+    wb.close()
+
+    return excel_buffer_styled.getvalue()
+
 # --- Interface Streamlit ---
 st.title("Contrôle des données de Télérelève")
 st.markdown("Veuillez téléverser votre fichier pour lancer les contrôles.")
@@ -267,18 +617,13 @@ if uploaded_file is not None:
 
     try:
         file_extension = uploaded_file.name.split('.')[-1]
-        
-        # Définir le type de données pour les colonnes pour éviter la notation scientifique
-        dtype_mapping = {
-            'Numéro de branchement': str,
-            'Abonnement': str
-        }
-
-        if file_extension == 'csv':
-            delimiter = get_csv_delimiter(uploaded_file)
-            df = pd.read_csv(uploaded_file, sep=delimiter, dtype=dtype_mapping)
-        elif file_extension == 'xlsx':
-            df = pd.read_excel(uploaded_file, dtype=dtype_mapping)
+
+        if file_extension in ('csv', 'xlsx'):
+            # getvalue() renvoie tout le contenu sans dépendre de la position du curseur ;
+            # son empreinte sert de clé de cache pour la lecture et pour les contrôles
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hashlib.sha256(file_bytes).hexdigest()
+            df, delimiter = load_dataframe(file_hash, file_bytes, file_extension)
         else:
             st.error("Format de fichier non pris en charge. Veuillez utiliser un fichier .csv ou .xlsx.")
             st.stop()
@@ -291,13 +636,16 @@ if uploaded_file is not None:
 
     if st.button("Lancer les contrôles"):
         st.write("Contrôles en cours...")
-        anomalies_df, anomaly_counter = check_data(df)
+        anomalies_df, anomaly_counter = check_file(file_hash, df)
 
         if not anomalies_df.empty:
             st.error("Anomalies détectées !")
-            # Suppression de la colonne temporaire pour l'affichage
-            anomalies_df_display = anomalies_df.drop(columns=['Anomalie Détaillée FP2E'])
+            # Suppression de la colonne temporaire pour l'affichage ; seules les premières lignes
+            # sont envoyées au navigateur, le fichier complet reste disponible au téléchargement
+            anomalies_df_display = anomalies_df.head(NB_LIGNES_AFFICHEES).drop(columns=['Anomalie Détaillée FP2E'])
             st.dataframe(anomalies_df_display)
+            if len(anomalies_df) > NB_LIGNES_AFFICHEES:
+                st.caption(f"Affichage limité aux {NB_LIGNES_AFFICHEES} premières lignes sur {len(anomalies_df)} lignes en anomalie. Téléchargez le fichier complet ci-dessous.")
             afficher_resume_anomalies(anomaly_counter)
             
             # Dictionnaire pour mapper les anomalies aux colonnes
@@ -329,7 +677,7 @@ if uploaded_file is not None:
             }
 
             if file_extension == 'csv':
-                csv_file = anomalies_df_display.to_csv(index=False, sep=delimiter).encode('utf-8')
+                csv_file = build_csv_report(file_hash, anomalies_df, delimiter)
                 st.download_button(
                     label="Télécharger les anomalies en CSV",
                     data=csv_file,
@@ -337,206 +685,10 @@ if uploaded_file is not None:
                     mime='text/csv',
                 )
             elif file_extension == 'xlsx':
-                excel_buffer = io.BytesIO()
-                
-                wb = Workbook()
-                
-                default_sheet = wb.active
-                wb.remove(default_sheet)
-                ws_summary = wb.create_sheet(title="Récapitulatif", index=0)
-                
-                ws_all_anomalies = wb.create_sheet(title="Toutes_Anomalies", index=1)
-                for r_df_idx, row_data in enumerate(dataframe_to_rows(anomalies_df_display, index=False, header=True)):
-                    ws_all_anomalies.append(row_data)
-
-                header_font = Font(bold=True)
-                red_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-
-                for cell in ws_all_anomalies[1]:
-                    cell.font = header_font
-
-                for row_num_all, df_row in enumerate(anomalies_df.iterrows()):
-                    anomalies = str(df_row[1]['Anomalie']).split(' / ')
-                    
-                    # Logique de coloriage pour FP2E
-                    fp2e_anomalies = [a for a in anomalies if 'FP2E' in a]
-                    if fp2e_anomalies:
-                        fp2e_details = str(df_row[1]['Anomalie Détaillée FP2E']).split(' / ')
-                        
-                        if 'Année fabrication différente' in fp2e_details or 'Année fabrication manquante ou invalide' in fp2e_details or 'Année millésime non conforme FP2E' in fp2e_details:
-                            try:
-                                col_index = list(anomalies_df_display.columns).index('Année de fabrication') + 1
-                                cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                                cell.fill = red_fill
-                            except ValueError:
-                                pass
-                        
-                        if 'Diamètre non conforme FP2E' in fp2e_details:
-                            try:
-                                col_index = list(anomalies_df_display.columns).index('Diametre') + 1
-                                cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                                cell.fill = red_fill
-                            except ValueError:
-                                pass
-                        
-                        if 'Format de compteur non FP2E' in fp2e_details or 'Erreur de format interne' in fp2e_details:
-                             try:
-                                col_index = list(anomalies_df_display.columns).index('Numéro de compteur') + 1
-                                cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                                cell.fill = red_fill
-                             except ValueError:
-                                pass
-                    
-                    # Autres anomalies
-                    for anomaly in anomalies:
-                        anomaly_key = anomaly.strip()
-                        if anomaly_key in anomaly_columns_map:
-                            columns_to_highlight = anomaly_columns_map[anomaly_key]
-                            for col_name in columns_to_highlight:
-                                try:
-                                    col_index = list(anomalies_df_display.columns).index(col_name) + 1
-                                    cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                                    cell.fill = red_fill
-                                except ValueError:
-                                    pass
-
-                for col in ws_all_anomalies.columns:
-                    max_length = 0
-                    column = col[0].column
-                    for cell in col:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    ws_all_anomalies.column_dimensions[get_column_letter(column)].width = adjusted_width
-
-                title_font = Font(bold=True, size=16)
-                
-                ws_summary['A1'] = "Récapitulatif des anomalies"
-                ws_summary['A1'].font = title_font
-                
-                ws_summary.append([])
-                ws_summary.append(["Type d'anomalie", "Nombre de cas"])
-                ws_summary['A3'].font = header_font
-                ws_summary['B3'].font = header_font
-                
-                created_sheet_names = set(["Récapitulatif", "Toutes_Anomalies"])
-
-                row_num_all_anomalies = ws_summary.max_row + 1
-                ws_summary.cell(row=row_num_all_anomalies, column=1, value="Toutes les anomalies").hyperlink = f"#'Toutes_Anomalies'!A1"
-                ws_summary.cell(row=row_num_all_anomalies, column=1).font = Font(underline="single", color="0563C1")
-                ws_summary.cell(row=row_num_all_anomalies, column=2, value=len(anomalies_df))
-                ws_summary.cell(row=row_num_all_anomalies, column=2).alignment = Alignment(horizontal="right")
-                
-                for r_idx, (anomaly_type, count) in enumerate(anomaly_counter.items()):
-                    # Logique pour raccourcir le nom de la feuille
-                    sheet_name_base = anomaly_type
-                    sheet_name = re.sub(r'[\\/?*\[\]:()\'"<>|]', '', sheet_name_base)
-                    sheet_name = sheet_name.replace(' ', '_').replace('.', '').replace(':', '_').strip()
-                    if len(sheet_name) > 31:
-                        sheet_name = sheet_name[:31].rstrip('_').strip()
-                    
-                    original_sheet_name = sheet_name
-                    counter = 1
-                    while sheet_name in created_sheet_names:
-                        sheet_name = f"{original_sheet_name[:28]}_{counter}"
-                        counter += 1
-                    created_sheet_names.add(sheet_name)
-
-                    row_num = ws_summary.max_row + 1
-                    ws_summary.cell(row=row_num, column=1, value=anomaly_type)
-                    ws_summary.cell(row=row_num, column=2, value=count)
-                    
-                    ws_anomaly_detail = wb.create_sheet(title=sheet_name)
-                    
-                    filtered_df = anomalies_df[anomalies_df['Anomalie'].str.contains(anomaly_type, regex=False)]
-                    
-                    for r_df_idx, row_data in enumerate(dataframe_to_rows(filtered_df.drop(columns=['Anomalie Détaillée FP2E']), index=False, header=True)):
-                        ws_anomaly_detail.append(row_data)
-
-                    for cell in ws_anomaly_detail[1]:
-                        cell.font = header_font
-                    
-                    for row_num_detail, df_row in enumerate(filtered_df.iterrows()):
-                        anomalies = str(df_row[1]['Anomalie']).split(' / ')
-
-                        # Logic to handle FP2E coloring in detail sheet
-                        fp2e_anomalies = [a for a in anomalies if 'FP2E' in a]
-                        if fp2e_anomalies:
-                            fp2e_details = str(df_row[1]['Anomalie Détaillée FP2E']).split(' / ')
-                            if 'Année fabrication différente' in fp2e_details or 'Année fabrication manquante ou invalide' in fp2e_details or 'Année millésime non conforme FP2E' in fp2e_details:
-                                try:
-                                    col_index = list(anomalies_df_display.columns).index('Année de fabrication') + 1
-                                    cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                    cell.fill = red_fill
-                                except ValueError:
-                                    pass
-                            
-                            if 'Diamètre non conforme FP2E' in fp2e_details:
-                                try:
-                                    col_index = list(anomalies_df_display.columns).index('Diametre') + 1
-                                    cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                    cell.fill = red_fill
-                                except ValueError:
-                                    pass
-                            
-                            if 'Format de compteur non FP2E' in fp2e_details or 'Erreur de format interne' in fp2e_details:
-                                 try:
-                                    col_index = list(anomalies_df_display.columns).index('Numéro de compteur') + 1
-                                    cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                    cell.fill = red_fill
-                                 except ValueError:
-                                    pass
-
-                        # Other anomalies
-                        for anomaly in anomalies:
-                            anomaly_key = anomaly.strip()
-                            if anomaly_key in anomaly_columns_map:
-                                columns_to_highlight = anomaly_columns_map[anomaly_key]
-                                for col_name in columns_to_highlight:
-                                    try:
-                                        col_index = list(anomalies_df_display.columns).index(col_name) + 1
-                                        cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                        cell.fill = red_fill
-                                    except ValueError:
-                                        pass
-
-                    for col in ws_anomaly_detail.columns:
-                        max_length = 0
-                        column = col[0].column
-                        for cell in col:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = (max_length + 2)
-                        ws_anomaly_detail.column_dimensions[get_column_letter(column)].width = adjusted_width
-
-                    ws_summary.cell(row=row_num, column=1).hyperlink = f"#'{sheet_name}'!A1"
-                    ws_summary.cell(row=row_num, column=1).font = Font(underline="single", color="0563C1")
-                    
-                for col in ws_summary.columns:
-                    max_length = 0
-                    column = col[0].column
-                    for cell in col:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    ws_summary.column_dimensions[get_column_letter(column)].width = adjusted_width
-                    
-                excel_buffer_styled = io.BytesIO()
-                wb.save(excel_buffer_styled)
-                excel_buffer_styled.seek(0)
-
+                excel_file = build_excel_report(file_hash, anomalies_df, anomaly_counter, anomaly_columns_map)
                 st.download_button(
                     label="Télécharger les anomalies en Excel",
-                    data=excel_buffer_styled,
+                    data=excel_file,
                     file_name='anomalies_telerelève.xlsx',
                     mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                 )